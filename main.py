@@ -13,6 +13,10 @@
 
 
 # Imports
+# asyncio, multiprocessing.shared_memory, PIL and scipy are slow to import, so they are
+# imported by the functions that use them. This keeps --help, --dry-run and the progress
+# tracker (and pool processes, when they are started fresh instead of being copied from this
+# process) from waiting on modules they never use.
 
 # Multiprocessing
 
@@ -21,14 +25,16 @@ import multiprocessing
 # Math
 
 import math
-import scipy
-import scipy.spatial
 
 # Other
 
+import argparse
+import base64
+import contextlib
 import ctypes
+import io
+import json
 import os
-import PIL.Image
 import random
 import time
 import traceback
@@ -42,6 +48,27 @@ class Dot:
         self.y = y
         self.type = dot_type
 
+class GenerationError(Exception):
+    # Raised when a piece keeps failing, or a finished map has missing parts
+    pass
+
+class MapState:
+    # Everything needed to regenerate part of a finished map
+    def __init__(
+        self, width, height, map_resolution, coastline_smoothing, scale, seed, dots, land, image
+    ):
+        self.width = width
+        self.height = height
+        self.map_resolution = map_resolution # Includes scale, see generate_map
+        self.coastline_smoothing = coastline_smoothing
+        self.scale = scale
+        self.seed = seed
+        self.dots = dots
+        self.land = land
+        # Whether each dot was land when its biome was decided, so dots changed between land and
+        # water since then can be found (see regenerate_region)
+        self.image = image
+
 
 # Text Colors
 
@@ -50,20 +77,163 @@ ANSI_BLUE = "\u001b[38;5;4m"
 ANSI_RESET = "\u001b[0m"
 
 
+# Settings
+
+SETTING_RANGES = {
+    "width": (500, 10_000),
+    "height": (500, 10_000),
+    "map_resolution": (50, 500),
+    "island_abundance": (10, 1000),
+    "island_size": (10, 100), # Divided by 10 before use
+    "coastline_smoothing": (0, 100),
+    "processes": (1, 64) # Change this for CPUs with >64 threads
+} # Minimum and maximum (both inclusive) for each setting
+
+
+# Sections
+
+SECTION_NAMES = [
+    "Setup", "Section Generation", "Section Assignment", "Coastline Smoothing",
+    "Biome Generation", "Image Generation", "Finish"
+]
+SECTION_WEIGHTS = [0.02, 0.01, 0.11, 0.38, 0.29, 0.17, 0.02]
+# Used for overall progress bar (e.g. Setup takes ~2% of total time)
+
+
+# Estimates
+# Measured with one thread, see estimate_map
+
+ESTIMATE_DOT_SECONDS = 0.0002 # Section Assignment and Biome Generation, per dot
+ESTIMATE_SMOOTHING_SECONDS = 0.0003 # Coastline Smoothing, per dot
+ESTIMATE_PIXEL_SECONDS = 0.000004 # Image Generation, per pixel
+ESTIMATE_DOT_BYTES = 200 # Memory used by one copy of a Dot
+ESTIMATE_PIXEL_BYTES = 7 # Frame buffer (3 bytes per pixel) and saved image (4 bytes per pixel)
+
+
+# Server
+
+SERVER_QUEUE_SIZE = 16 # Maps waiting to be generated, more requests than this are refused
+SERVER_CHUNK_SIZE = 65_536 # Bytes of png sent at a time
+
+
+# Failed Pieces
+
+RETRIES = 2 # Also in the --retries help text
+# Default number of times a failed piece is run again before generation stops, see --retries
+# 0 stops generation as soon as any piece fails
+
+
+# Seeds
+
+SEED_BLOCK_SIZE = 1_000
+# Section Assignment draws random numbers for blocks of this many dots, each block with its own
+# seed, so a seed makes the same map with any number of threads (see assign_sections)
+
+
+# Dot Types
+
+DOT_TYPES = (
+    "Ice", "Shallow Water", "Water", "Deep Water",
+    "Rock", "Desert", "Jungle", "Forest", "Plains", "Taiga", "Snow"
+) # Every type a dot can have after Biome Generation, in the order used for statistics
+WATER_TYPES = DOT_TYPES[:4]
+# Every other type (after Biome Generation) is land
+
+
+# Preview
+
+PREVIEW_SCALE = 4
+# Preview images are 1/4 of the width and height of the result, and use 1/16 as many dots
+
+
 # Functions
 # (Alphabetical order)
 
+def check_dots(local_dots): # Makes sure every dot has a biome before Image Generation
+    leftover_types = set([dot.type for dot in local_dots if dot.type not in DOT_TYPES])
+    if len(leftover_types) > 0: # E.g. "Land Origin" that was never cleaned
+        raise GenerationError("Dots left with types " + ", ".join(sorted(leftover_types)))
+
+def check_pixels(frame_buffer, width, height): # Makes sure an image is complete before saving
+    # Each row of frame_buffer is marked once it is written, see generate_image
+    rows_written = bytes(frame_buffer.buf[width * height * 3:width * height * 3 + height]).count(1)
+    if rows_written != height: # Part of the image was never generated
+        raise GenerationError("Generated " + str(rows_written) + " of " + str(height) + " rows")
+
 def clear_screen():
     command = "clear"
     if os.name in ("nt", "dos"):
         command = "cls"
     os.system(command)
 
+def estimate_map(width, height, map_resolution, coastline_smoothing, processes):
+
+    # Returns the number of dots, memory used (bytes) and time taken (seconds) for a map
+    # Only uses the settings, so nothing slow to import (e.g. scipy) is needed
+
+    num_dots = width * height // map_resolution
+
+    memory = num_dots * ESTIMATE_DOT_BYTES * (processes + 2) + width * height * ESTIMATE_PIXEL_BYTES
+    # Every pool process has a copy of the dots, as well as this process and the manager
+
+    seconds_per_dot = ESTIMATE_DOT_SECONDS
+    if coastline_smoothing != 0:
+        seconds_per_dot += ESTIMATE_SMOOTHING_SECONDS
+    seconds = (num_dots * seconds_per_dot + width * height * ESTIMATE_PIXEL_SECONDS) / processes
+
+    return num_dots, memory, seconds
+
 def format_time(time_seconds): # E.g. 86.34521s --> 01:26.345
     seconds = f"{(time_seconds % 60):.3f}".rjust(6, "0")
     minutes = str(int(time_seconds // 60))
     return (minutes + ":" + seconds).rjust(8)
 
+def get_biome(y, height, rng): # Random biome for a biome origin dot at height y, using rng
+
+    equator_dist = abs(y - height / 2) / height * 20
+    # Distance from equator 0-10, where 0 is on equator and 10 is top or bottom of page
+
+    if equator_dist < 1:
+        probs = ["Rock"] + ["Desert"] * 3 + ["Jungle"] * 3 + ["Forest"] * 2 + ["Plains"]
+    elif equator_dist < 2:
+        probs = (
+            ["Rock"] + ["Desert"] * 3 + ["Jungle"] * 2 + ["Forest"] * 2 + ["Plains"] * 2
+        )
+    elif equator_dist < 3:
+        probs = ["Rock"] + ["Desert"] * 2 + ["Jungle"] + ["Forest"] * 3 + ["Plains"] * 3
+    elif equator_dist < 4:
+        probs = ["Rock"] + ["Desert"] + ["Jungle"] + ["Forest"] * 3 + ["Plains"] * 4
+    elif equator_dist < 5:
+        probs = ["Rock"] + ["Desert"] + ["Forest"] * 4 + ["Plains"] * 4
+    elif equator_dist < 6:
+        probs = ["Rock"] +  ["Forest"] * 5 + ["Plains"] * 4
+    elif equator_dist < 7:
+        probs = ["Rock"] + ["Taiga"] + ["Forest"] * 5 + ["Plains"] * 3
+    elif equator_dist < 8:
+        probs = (
+            ["Rock"] +  ["Snow"] * 2 + ["Taiga"] * 2 + ["Forest"] * 3 + ["Plains"] * 2
+        )
+    elif equator_dist < 9:
+        probs = ["Snow"] * 4 + ["Taiga"] * 5 + ["Forest"]
+    else:
+        probs = ["Snow"] * 10
+
+    # Probability Chart, 1 box = 10% Chance
+    # r = Rock, D = Desert, etc. Numbers represent equator distance
+    # Uppercase/lowercase are an attempt to make it easier to read, they mean nothing
+    # 0-1 | r D D D J J J f f P
+    # 1-2 | r D D D J J f f P P
+    # 2-3 | r D D J f f f P P P
+    # 3-4 | r D J f f f P P P P
+    # 4-5 | r D f f f f P P P P
+    # 5-6 | r f f f f f P P P P
+    # 6-7 | r T f f f f f P P P
+    # 7-8 | r s s T T f f f P P
+    # 8-9 | s s s s T T T T f f
+    # 9-10| s s s s s s s s s s
+
+    return probs[rng.randint(0, 9)]
+
 def get_int(min, max): # Integer input sanitization
 
     while True:
@@ -83,40 +253,267 @@ def get_int(min, max): # Integer input sanitization
 
     return choice
 
+def load_state(path): # Reads a MapState saved by save_state
+
+    import PIL.Image
+
+    with open(path) as file:
+        saved = json.load(file)
+
+    image = PIL.Image.open(io.BytesIO(base64.b64decode(saved["image"])))
+    image.load() # Otherwise the image is only read when it is first used
+
+    return MapState(
+        saved["width"], saved["height"], saved["map_resolution"], saved["coastline_smoothing"],
+        saved["scale"], saved["seed"],
+        [Dot(x, y, dot_type) for x, y, dot_type in saved["dots"]], saved["land"], image
+    )
+
+def parse_settings(request): # Settings sanitization for maps requested from the server
+
+    # Returns (width, height, map_resolution, island_abundance, island_size, coastline_smoothing,
+    # seed, preview), raising ValueError if a setting is missing or invalid
+    # preview is optional, and makes the map in preview mode (see PREVIEW_SCALE)
+
+    if type(request) is not dict:
+        raise ValueError("Request must be a JSON object.")
+
+    settings = []
+
+    for name in (
+        "width", "height", "map_resolution", "island_abundance", "island_size",
+        "coastline_smoothing"
+    ):
+
+        value = request.get(name)
+        min, max = SETTING_RANGES[name]
+
+        if type(value) is not int:
+            raise ValueError(name + " must be a whole number.")
+        if not min <= value <= max:
+            raise ValueError(
+                name + " must be between " + str(min) + " and " + str(max) + " (both inclusive)."
+            )
+
+        settings.append(value)
+
+    settings[4] /= 10 # Island size
+
+    seed = request.get("seed")
+    if seed is None:
+        seed = random.SystemRandom().randrange(2 ** 32)
+        # Requests without a seed are never the same as another request
+        # Not drawn from random, so maps being generated meanwhile aren't changed
+    if type(seed) is not int or seed < 0:
+        raise ValueError("seed must be a positive whole number.")
+    settings.append(seed)
+
+    preview = request.get("preview", False)
+    if type(preview) is not bool:
+        raise ValueError("preview must be true or false.")
+    settings.append(preview)
+
+    return tuple(settings)
+
+def print_statistics(type_counts, sample_count):
+
+    # Prints the share of land, water, and each type, from type_counts (pixels of each type)
+    # If type_counts only includes sample_count sampled pixels (see sample_types),
+    # each overall percentage is followed by its 95% margin of error
+
+    text_colors = ("117", "21", "19", "17", "243", "229", "22", "28", "40", "48", "255")
+    # Colored text for biome labels
+
+    count_total = sum(type_counts)
+    if count_total == 0:
+        print("No pixels were counted.")
+        return
+
+    def margin(count): # E.g. " ± 0.25%", for a share of count / count_total
+        if sample_count == 0:
+            return ""
+        share = count / count_total
+        return " ± " + "{:.2f}%".format(1.96 * math.sqrt(share * (1 - share) / sample_count) * 100)
+        # Treats samples as independent, samples on a grid are usually a little more accurate
+
+    count_water = sum(type_counts[:4])
+    count_land = sum(type_counts[4:])
+    print(
+        "Water " +
+        "{:.2f}%".format(count_water / count_total * 100).rjust(6) + margin(count_water)
+    )
+    print(
+        "Land  " +
+        "{:.2f}%".format(count_land / count_total * 100).rjust(6) + margin(count_land)
+    )
+
+    print("     % of Land/Water | % of Total")
+    for i in range(11):
+        if i < 4:
+            count_group = count_water
+        else:
+            count_group = count_land
+        print(
+            "\u001b[48;5;" + text_colors[i] + "m" + DOT_TYPES[i].ljust(13) + ANSI_RESET + # Label
+            "{:.2f}%".format(type_counts[i] / max(count_group, 1) * 100).rjust(7) + " | " +
+            # Percentage of land/water e.g. 30% of all land is forest
+            "{:.2f}%".format(type_counts[i] / count_total * 100).rjust(6) + # Overall percentage
+            margin(type_counts[i])
+        )
+
 def raise_error(location, traceback_output):
     # Errors in the terminal are often overwritten, so this saves them to error.txt
     with open("errors.txt", "a") as file:
         file.write("Error at " + location + "\n\n" + traceback_output + "\n\n\n")
 
+def run_pieces(pool, function, args_list, retries, piece_pids):
+    # Runs function once for each tuple in args_list using pool, and returns the results
+    # A failed piece is run again, up to retries times, before GenerationError is raised
+    # retries == 0 stops generation at the first failed piece
+    # A piece also fails if the process running it dies (e.g. killed for using too much memory),
+    # found using piece_pids (see run_piece), as pool never finishes that piece's result
+
+    known_pids = [process.pid for process in multiprocessing.active_children()]
+    # Processes that were running when last checked
+
+    for i in range(len(args_list)):
+        piece_pids[i] = 0 # Set by run_piece once a process starts the piece
+    results = [
+        pool.apply_async(run_piece, (function, i, args_list[i])) for i in range(len(args_list))
+    ]
+    attempts = [0] * len(args_list)
+    waiting = list(range(len(args_list)))
+
+    while len(waiting) > 0:
+
+        pids = piece_pids[:len(args_list)]
+        running_pids = [process.pid for process in multiprocessing.active_children()]
+        # pids is read first, so a piece's process is always started before running_pids
+
+        unknown_loss = len([
+            pid for pid in known_pids if pid not in running_pids and pid not in pids
+        ]) > 0
+        # A process died before run_piece could record which piece it had, e.g. while the
+        # piece's arguments (which include every dot) were being copied into it
+        known_pids = running_pids
+
+        for i in list(waiting):
+
+            if results[i].ready():
+                if results[i].successful():
+                    waiting.remove(i)
+                    continue
+                reason = "failed"
+            elif pids[i] != 0 and pids[i] not in running_pids:
+                reason = "lost its process" # Pool starts a new process in its place
+            elif pids[i] == 0 and unknown_loss:
+                reason = "may have lost its process"
+                # Every piece that hasn't started could be the one, so all of them are run again
+                # A piece that was only waiting then runs twice, which gives the same result
+            else:
+                continue # Still running, or waiting for a process
+
+            if attempts[i] < retries:
+                attempts[i] += 1
+                piece_pids[i] = 0
+                results[i] = pool.apply_async(run_piece, (function, i, args_list[i]))
+                # Retry only this piece
+            else:
+                raise GenerationError(
+                    function.__name__ + " " + reason + " for piece " + str(i + 1) + " of " +
+                    str(len(args_list)) + " after " + str(attempts[i] + 1) + " attempt(s)"
+                ) # Pieces still running are stopped when the pool closes
+
+        if len(waiting) > 0:
+            time.sleep(0.01) # Checking more often than this wastes CPU time
+
+    return [result.get() for result in results]
+
+def save_state(state, path):
+
+    # Saves state as JSON, so part of its map can be regenerated later (see run_region)
+    # Dots are saved as [x, y, type], so types can be changed to "Land" or "Water" by hand,
+    # and the image as a base64 png
+
+    image_file = io.BytesIO()
+    state.image.save(image_file, "PNG")
+
+    with open(path, "w") as file:
+        json.dump({
+            "width": state.width,
+            "height": state.height,
+            "map_resolution": state.map_resolution,
+            "coastline_smoothing": state.coastline_smoothing,
+            "scale": state.scale,
+            "seed": state.seed,
+            "dots": [[dot.x, dot.y, dot.type] for dot in state.dots],
+            "land": state.land,
+            "image": base64.b64encode(image_file.getvalue()).decode()
+        }, file)
+
+@contextlib.contextmanager
+def start_pool(processes):
+
+    # Starts a pool of processes, and the variables it shares, for every mode that generates maps
+    # Yields (pool, section_progress, section_progress_total, section_times, dots, piece_pids),
+    # and stops the pool when the with block ends
+
+    import multiprocessing.resource_tracker
+    import scipy.spatial
+    # Imported before the pool starts, so pool processes copied from this process (the default
+    # on Linux) already have it instead of each importing it, see also set_forkserver_preload
+
+    with open("errors.txt", "w") as file:
+        file.write("")
+
+    section_progress = multiprocessing.Array(ctypes.c_int, [0, 0, 0, 0, 0, 0, 0])
+    section_progress_total = multiprocessing.Array(ctypes.c_int, [1, 1, 1, 1, 1, 1, 1])
+    section_times = multiprocessing.Array(ctypes.c_double, [0, 0, 0, 0, 0, 0, 0])
+    lock = multiprocessing.Lock()
+    # Lock to prevent two processes from updating the same variable simultaneously
+    piece_pids = multiprocessing.Array(ctypes.c_int, [0] * SETTING_RANGES["processes"][1])
+    # Process running each piece, there are never more pieces than processes (see run_pieces)
+
+    if os.name == "posix":
+        multiprocessing.resource_tracker.ensure_running()
+        # Pool processes share this process' tracker for frame buffers (see generate_image),
+        # instead of each starting one that removes the frame buffer again when it exits
+
+    with multiprocessing.Manager() as manager:
+
+        dots = manager.list([])
+
+        with multiprocessing.Pool(processes, initializer=initialize_pool,
+        initargs=(section_progress, dots, lock, piece_pids)) as pool:
+            yield pool, section_progress, section_progress_total, section_times, dots, piece_pids
+
 
 # Multiprocessing Functions
 # (Order of use)
 
-def initialize_pool(section_progress_value, dots_value, image_sections_value, lock_value):
+def initialize_pool(section_progress_value, dots_value, lock_value, piece_pids_value):
 
     # Creates shared variables
 
     global section_progress
     global dots
-    global image_sections # Holder for image pieces in generate_image
     global lock # Lock to prevent two processes from updating the same variable simultaneously
+    global piece_pids # Process running each piece, see run_pieces
 
     section_progress = section_progress_value
     dots = dots_value
-    image_sections = image_sections_value
     lock = lock_value
+    piece_pids = piece_pids_value
+
+def run_piece(function, piece, args):
+    # Runs one piece for run_pieces, after recording which process is running it
+    piece_pids[piece] = os.getpid()
+    return function(*args)
 
 def track_progress(section_progress, section_progress_total, section_times, start_time):
 
     try:
 
-        section_names = [
-            "Setup", "Section Generation", "Section Assignment", "Coastline Smoothing",
-            "Biome Generation", "Image Generation", "Finish"
-        ]
-        section_weights = [0.02, 0.01, 0.11, 0.38, 0.29, 0.17, 0.02]
-        # Used for overall progress bar (e.g. Setup takes ~2% of total time)
-
         while True:
 
             clear_screen()
@@ -127,12 +524,13 @@ def track_progress(section_progress, section_progress_total, section_times, star
 
             total_progress = 0
 
-            for i in range(len(section_names)):
+            for i in range(len(SECTION_NAMES)):
 
-                progress_section = section_progress[i] / section_progress_total[i]
-                total_progress += progress_section * section_weights[i]
+                progress_section = min(section_progress[i] / section_progress_total[i], 1)
+                # Retried pieces can count some steps twice
+                total_progress += progress_section * SECTION_WEIGHTS[i]
 
-                if section_progress[i] == section_progress_total[i]: # Checking if section complete
+                if section_progress[i] >= section_progress_total[i]: # Checking if section complete
                     color = ANSI_GREEN
                     section_time = section_times[i] # Section complete
                 else:
@@ -143,7 +541,7 @@ def track_progress(section_progress, section_progress_total, section_times, star
                         section_time = 0 # Section hasn't started
 
                 print(
-                    color + "[" + str(i + 1) + "/7] " + section_names[i].ljust(20) + # Section name
+                    color + "[" + str(i + 1) + "/7] " + SECTION_NAMES[i].ljust(20) + # Section name
                     "{:.2f}% ".format(progress_section * 100).rjust(8) + # Section progress %
                     ANSI_GREEN + "█" * round(progress_section * 20) + # Green part of progress bar
                     ANSI_BLUE + "█" * (20 - round(progress_section * 20)) + # Blue part of bar
@@ -152,7 +550,9 @@ def track_progress(section_progress, section_progress_total, section_times, star
 
             # Total Progress
 
-            if sum(section_progress) == sum(section_progress_total):
+            finished = all([section_progress[i] >= section_progress_total[i] for i in range(7)])
+
+            if finished:
                 color = ANSI_GREEN # All sections complete
             else:
                 color = ANSI_BLUE # Section in progress
@@ -164,7 +564,7 @@ def track_progress(section_progress, section_progress_total, section_times, star
                 ANSI_RESET + " " + format_time(time_now - start_time) # Total time
             )
 
-            if sum(section_progress) == sum(section_progress_total):
+            if finished:
                 break # Tracking process ends when all section have completed
             else:
                 time.sleep(0.1) # Delay before refreshing
@@ -176,15 +576,24 @@ def copy_piece(piece_range):
     # For copying dots into local_dots, as a local variable is faster to access
     return dots[piece_range[0]:piece_range[1]]
 
-def assign_sections(map_resolution, island_size, piece_range, origin_dots, local_dots):
+def assign_sections(map_resolution, island_size, seed, piece_range, origin_dots, local_dots):
 
     try:
 
+        import scipy.spatial
+
+        chances = [] # Random numbers for the block of dots i is in
+
         # Used to find the nearest origin dot
         tree = scipy.spatial.KDTree([(dot.x, dot.y) for dot in origin_dots])
 
         for i in range(piece_range[0], piece_range[1]):
 
+            if i == piece_range[0] or i % SEED_BLOCK_SIZE == 0:
+                block_rng = random.Random((seed << 32) + i // SEED_BLOCK_SIZE)
+                chances = [block_rng.random() for ii in range(SEED_BLOCK_SIZE)]
+                # Blocks don't depend on piece_range, so maps can be repeated with any pieces
+
             dot = local_dots[i]
 
             if dot.type == "Water": # Ignore "Water Forced" and "Land Origin"
@@ -205,7 +614,7 @@ def assign_sections(map_resolution, island_size, piece_range, origin_dots, local
                 else:
                     chance = 0.1
 
-                if random.random() < chance:
+                if chances[i % SEED_BLOCK_SIZE] < chance:
                     dots[i] = Dot(dot.x, dot.y, "Land")
 
             with lock:
@@ -213,11 +622,43 @@ def assign_sections(map_resolution, island_size, piece_range, origin_dots, local
 
     except:
         raise_error("assign_sections", traceback.format_exc())
+        raise # Lets run_pieces know this piece failed
+
+def assign_sections_prior(piece_range, prior_dots, local_dots):
+
+    try:
+
+        import scipy.spatial
+
+        # Used to find the nearest dot of a previous, coarser map
+        tree = scipy.spatial.KDTree([(dot.x, dot.y) for dot in prior_dots])
+
+        for i in range(piece_range[0], piece_range[1]):
+
+            dot = local_dots[i]
+
+            prior_type = prior_dots[tree.query((dot.x, dot.y))[1]].type
+
+            if prior_type not in WATER_TYPES:
+                dots[i] = Dot(dot.x, dot.y, "Land") # Dot is land if the coarser map was land here
+
+            with lock:
+                section_progress[2] += 1
+
+    except:
+        raise_error("assign_sections_prior", traceback.format_exc())
+        raise # Lets run_pieces know this piece failed
 
 def smooth_coastlines(coastline_smoothing, piece_range, local_dots):
 
     try:
 
+        import scipy.spatial
+
+        piece_dots = local_dots[piece_range[0]:piece_range[1]]
+        # Dots in this piece as it changes them, read instead of dots, which a failed attempt at
+        # this piece may have already changed, so a retried piece gives the same result
+
         for i in (1, -1):
         # Smooths starting with first and last dot
         # (shouldn't make a difference, more of a just in case)
@@ -237,7 +678,7 @@ def smooth_coastlines(coastline_smoothing, piece_range, local_dots):
 
             for ii in list_dots:
 
-                dot = dots[ii]
+                dot = piece_dots[ii - piece_range[0]]
 
                 types = ["Land", "Water"]
 
@@ -268,67 +709,70 @@ def smooth_coastlines(coastline_smoothing, piece_range, local_dots):
                 # If average distance to the same type of dot is greater
                 # than average distance to opposite type dot for the nearest k dots
                     types.remove(dot.type)
+                    piece_dots[ii - piece_range[0]] = Dot(dot.x, dot.y, types[0])
                     with lock:
-                        dots[ii] = Dot(dot.x, dot.y, types[0])
+                        dots[ii] = piece_dots[ii - piece_range[0]]
 
                 with lock:
                     section_progress[3] += 1
 
     except:
         raise_error("smooth_coastlines", traceback.format_exc())
+        raise # Lets run_pieces know this piece failed
 
-def clean_dots(local_dots_section, start_index):
+def generate_biomes(piece_range, local_dots, biome_origin_dots, height):
 
     try:
 
-        # Remove all "Land Origin" and "Water Forced", which become "Land" and "Water"
-
-        for i in range(len(local_dots_section)):
+        import scipy.spatial
 
-            dot = local_dots_section[i]
+        # Replaces every type in piece_range with its final type, so "Land Origin" and
+        # "Water Forced" dots are removed as well
 
-            if dot.type == "Land Origin":
+        land_dots = [dot for dot in local_dots if dot.type in ("Land", "Land Origin")]
 
-                dots[i + start_index] = Dot(dot.x, dot.y, "Land")
+        land_tree = None
+        if len(land_dots) > 0:
+            land_tree = scipy.spatial.KDTree([(dot.x, dot.y) for dot in land_dots])
+        # Finds nearest land dot
 
-            elif dot.type == "Water Forced":
+        biome_origin_tree = None
+        if len(biome_origin_dots) > 0:
+            biome_origin_tree = scipy.spatial.KDTree([(dot.x, dot.y) for dot in biome_origin_dots])
+        # Finds nearest biome origin dot
+        # (a dot that sets the surrounding land to be a certain biome)
 
-                dots[i + start_index] = Dot(dot.x, dot.y, "Water")
+        for i in range(piece_range[0], piece_range[1]):
 
-    except:
-        raise_error("clean_dots", traceback.format_exc())
+            dot = local_dots[i]
 
-def generate_biomes_water(piece_range, local_dots, height):
+            if dot.type in ("Land", "Land Origin"):
 
-    try:
+                dot_type = biome_origin_dots[biome_origin_tree.query((dot.x, dot.y))[1]].type
+                # Dot becomes the type of the nearest biome origin dot
 
-        tree = (
-            scipy.spatial.KDTree([(dot.x, dot.y) for dot in local_dots if dot.type == "Land"])
-        )
-        # Finds nearest land dot
+            else: # "Water" or "Water Forced"
 
-        for i in [index for index in range(piece_range[0], piece_range[1])
-        if local_dots[index].type == "Water"]: # For every "Water" dot in piece_range
-
-            dot = dots[i]
-
-            equator_dist = abs(dot.y - height / 2) / height * 20
-            # Distance from equator 0-10, where 0 is on equator and 10 is top or bottom of page
-            land_dist = tree.query((dot.x, dot.y))[0]
-            # Distance to nearest land dot
-
-            if (
-                (land_dist < 35 and equator_dist > 9) or
-                (land_dist < 25 and equator_dist > 8) or
-                (land_dist < 15 and equator_dist > 7)
-            ):
-                dot_type = "Ice" # All water near poles is ice
-            elif land_dist < 18:
-                dot_type = "Shallow Water" # Near land is shallow
-            elif land_dist < 35:
-                dot_type = "Water"
-            else:
-                dot_type = "Deep Water" # Far from land is deep
+                equator_dist = abs(dot.y - height / 2) / height * 20
+                # Distance from equator 0-10, where 0 is on equator and 10 is top or bottom of page
+                if land_tree is None:
+                    land_dist = math.inf
+                else:
+                    land_dist = land_tree.query((dot.x, dot.y))[0]
+                # Distance to nearest land dot
+
+                if (
+                    (land_dist < 35 and equator_dist > 9) or
+                    (land_dist < 25 and equator_dist > 8) or
+                    (land_dist < 15 and equator_dist > 7)
+                ):
+                    dot_type = "Ice" # All water near poles is ice
+                elif land_dist < 18:
+                    dot_type = "Shallow Water" # Near land is shallow
+                elif land_dist < 35:
+                    dot_type = "Water"
+                else:
+                    dot_type = "Deep Water" # Far from land is deep
 
             dots[i] = Dot(dot.x, dot.y, dot_type)
 
@@ -336,58 +780,48 @@ def generate_biomes_water(piece_range, local_dots, height):
                 section_progress[4] += 1
 
     except:
-        raise_error("generate_biomes_water", traceback.format_exc())
-
-def assign_biomes(piece_range, biome_origin_dots, local_dots):
-
-    try:
-
-        tree = scipy.spatial.KDTree([(dot.x, dot.y) for dot in biome_origin_dots])
-        # Finds nearest biome origin dot
-        # (a dot that sets the surrounding land to be a certain biome)
+        raise_error("generate_biomes", traceback.format_exc())
+        raise
 
-        for i in [index for index in range(piece_range[0], piece_range[1])
-        if local_dots[index].type == "Land"]: # For every "Land" dot
-
-            dot = local_dots[i]
-
-            dots[i] = Dot(dot.x, dot.y, biome_origin_dots[tree.query((dot.x, dot.y))[1]].type)
-            # Dot becomes the type of the nearest biome origin dot
-            
-            with lock:
-                section_progress[4] += 1
-
-    except:
-        raise_error("assign_biomes", traceback.format_exc())
+def generate_image(
+    start_height, section_height, start_width, section_width, frame_buffer_name, buffer_row,
+    buffer_height, local_dots, dot_indexes, scale
+):
 
-def generate_image(start_height, section_height, process_num, local_dots, width):
+    frame_buffer = None
 
     try:
 
+        import multiprocessing.shared_memory
+        import scipy.spatial
+
         type_counts = [0] * 11
         # Counts pixels of each biome and water type for statistics
 
-        image_local = (
-            PIL.Image.new("RGB", (width, section_height), (255, 153, 194))
-        ) # Create empty image for section
-        pixels = image_local.load() # Load image into pixel array
+        frame_buffer = multiprocessing.shared_memory.SharedMemory(frame_buffer_name)
+        # Shared RGB image, section_width x buffer_height pixels, that rows are written straight
+        # into, followed by one byte for each row that is set to 1 once the row is written
+        # This section starts at row buffer_row of frame_buffer
+        rows_offset = section_width * buffer_height * 3
+        row = bytearray(section_width * 3) # Pixels of one row, 3 bytes (RGB) each
         tree = scipy.spatial.KDTree([(dot.x, dot.y) for dot in local_dots])
         # Find nearest dot to a point
 
         for y in range(section_height):
 
-            indexes = tree.query([(x, y + start_height) for x in range(width)])[1]
+            indexes = tree.query(
+                [((x + start_width) * scale, (y + start_height) * scale)
+                for x in range(section_width)]
+            )[1]
             # Finds nearest dot's index for every x value in the row y
+            # For previews (scale > 1), each pixel covers a scale x scale square of the map
 
-            for x in range(width):
+            for x in range(section_width):
 
                 pixel_type = "Error"
                 pixel_type = local_dots[indexes[x]].type # Find pixel type
 
-                type_counts[(
-                    "Ice", "Shallow Water", "Water", "Deep Water",
-                    "Rock", "Desert", "Jungle", "Forest", "Plains", "Taiga", "Snow"
-                ).index(pixel_type)] += 1
+                type_counts[DOT_TYPES.index(pixel_type)] += 1
 
                 match (pixel_type): # Assign color based on type
                     case "Ice":
@@ -419,407 +853,1030 @@ def generate_image(start_height, section_height, process_num, local_dots, width)
                 for i in range(len(colors)):
                     # Adds slight color variation
                     # Every pixel around the same dot has the same variation
-                    colors[i] += indexes[x] % 20 - 10
+                    # dot_indexes keeps the variation the same when only part of a map is redone
+                    colors[i] += dot_indexes[indexes[x]] % 20 - 10
                     if colors[i] > 255:
                         colors[i] = 255
                     elif colors[i] < 0:
                         colors[i] = 0
-                pixels[x, y] = tuple(colors) # Update image section with pixel color
+                row[x * 3:x * 3 + 3] = colors # Update row with pixel color
+
+            offset = (buffer_row + y) * section_width * 3
+            frame_buffer.buf[offset:offset + len(row)] = row
+            frame_buffer.buf[rows_offset + buffer_row + y] = 1 # See check_pixels
 
             with lock:
                 section_progress[5] += 1
 
-        image_sections[process_num] = image_local
-
         return type_counts
 
     except:
         raise_error("generate_image", traceback.format_exc())
-        return [0] * 11
+        raise
 
+    finally:
+        if frame_buffer is not None:
+            frame_buffer.close() # Closed even if this attempt fails, before it is retried
 
-# Main Function
+def sample_types(start_height, section_height, stride, local_dots, width, scale):
 
-def main():
+    try:
 
-    with open("errors.txt", "w") as file:
-        file.write("")
+        import scipy.spatial
 
-    clear_screen()
+        type_counts = [0] * 11
+        # Counts sampled pixels of each biome and water type for statistics
 
-    # Copyright, license notice, etc.
-    print(
-        "Welcome to BiomeGen v1.0\n" +
-        "Copyright (C) 2025 Liam Ralph\n" +
-        "https://github.com/liam-ralph\n" +
-        "This project is licensed under the GNU General Public License v3.0,\n" +
-        "except for result.png, this program's output, licensed under The Unlicense.\n" +
-        "\u001b[38;5;1mWARNING: In some terminals, the refreshing progress screen\n" + 
-        "may flash, which could cause problems for people with epilepsy.\n" + ANSI_RESET +
-        "Press ENTER to begin."
-    )
-    # I do not know if the flashing lights this program sometimes makes could reasonably cause
-    # epilepsy or not, but I put this just in case
-    input()
-    clear_screen()
+        tree = scipy.spatial.KDTree([(dot.x, dot.y) for dot in local_dots])
+        # Find nearest dot to a point
 
-    print("Map Width (pixels):")
-    width = get_int(500, 10_000)
+        for y in range(start_height, start_height + section_height):
 
-    print("\nMap Height:")
-    height = get_int(500, 10_000)
+            if y % stride == stride // 2:
+            # Only the centre pixel of every stride x stride square is sampled
 
-    print(
-        "\nMap resolution controls the section size of the map.\n" +
-        "Choose a number between 50 and 500. 100 is the default.\n" +
-        "Larger numbers produce lower resolutions, with larger pieces\n" +
-        "while lower numbers take longer to generate.\n" +
-        "Map Resolution:"
-    )
-    map_resolution = get_int(50, 500)
+                indexes = tree.query(
+                    [(x * scale, y * scale) for x in range(stride // 2, width, stride)]
+                )[1] # Each pixel covers a scale x scale square of the map, as in generate_image
 
-    print(
-        "\nIsland abundance control how many islands there are,\n" +
-        "and the ration of land to water.\n" +
-        "Choose a number between 10 and 1000. 120 is the default.\n" +
-        "Larger numbers produces less land.\n" +
-        "Island Abundance:"
-    )
-    island_abundance = get_int(10, 1000)
+                for index in indexes:
+                    type_counts[DOT_TYPES.index(local_dots[index].type)] += 1
 
-    print(
-        "\nIsland size controls average island size.\n" +
-        "Choose a number between 10 and 100. 50 is the default.\n" +
-        "Larger numbers produce larger islands.\n" +
-        "Island Size:"
-    )
-    island_size = get_int(10, 100) / 10
+            with lock:
+                section_progress[5] += 1
 
-    print(
-        "\nCoastline smoothing controls how smooth or rough coastlines look.\n" +
-        "Choose a number between 1 and 100. Larger numbers cause more smoothing.\n" +
-        "A value of 0 causes no smoothing. A value of 5 causes some smoothing,\n" +
-        "and is the default value.\n" +
-        "Coastline Smoothing:"
-    )
-    coastline_smoothing = get_int(0, 100)
+        return type_counts
 
-    print(
-        "\nNow you must choose how many of your CPU's threads to use for map generation.\n" +
-        "Values exceeding your CPU's number of threads will slow map generation.\n" +
-        "The most efficient number of threads to use varies by hardware, OS,\n" +
-        "and CPU load. Values less than 4 threads are usually very inefficient.\n" +
-        "Ensure you monitor your CPU for overheating, and halt the program if\n" +
-        "high temperatures occur. Using fewer threads may reduce temperatures.\n" +
-        "Number of Threads:"
-    )
-    processes = get_int(1, 64) # Change this for CPUs with >64 threads
+    except:
+        raise_error("sample_types", traceback.format_exc())
+        raise
 
-    start_time = time.time()
 
-    clear_screen()
+# Main Functions
 
-    manager = multiprocessing.Manager()
+def generate_map(
+    pool, processes, width, height, map_resolution, island_abundance, island_size,
+    coastline_smoothing, seed, scale, prior_dots, result_path, retries, show_progress,
+    sample_stride, dots_only, section_progress, section_progress_total, section_times, dots,
+    piece_pids
+):
+    # Runs every section once, saving the map to result_path and returning its MapState
+    # result_path can also be a file object, e.g. io.BytesIO
+    # sample_stride > 0 skips the image, and counts types for only some pixels (see sample_types)
+    # dots_only skips Image Generation completely, and returns None instead of type counts
+    # scale > 1 creates a smaller image with fewer dots, used for previews
+    # prior_dots (the dots of a coarser map) are used to decide land and biomes if given
 
-    section_progress = multiprocessing.Array(ctypes.c_int, [0, 0, 0, 0, 0, 0, 0])
-    section_progress_total = multiprocessing.Array(ctypes.c_int, [1, 1, 1, 1, 1, 1, 1])
-    section_times = multiprocessing.Array(ctypes.c_double, [0, 0, 0, 0, 0, 0, 0])
-    dots = manager.list([])
-    image_sections = manager.list([PIL.Image.new("RGB", (100, 100), (255, 0, 102))] * processes)
-    lock = multiprocessing.Lock()
-    # Lock to prevent two processes from updating the same variable simultaneously
+    start_time = time.time()
 
-    with multiprocessing.Pool(processes, initializer=initialize_pool,
-    initargs=(section_progress, dots, image_sections, lock)) as pool:
+    rng = random.Random(seed)
+    # Only rng is used, so other threads using random (e.g. serve_maps) can't change the map
 
-        try:
+    section_progress[:] = [0, 0, 0, 0, 0, 0, 0]
+    section_progress_total[:] = [1, 1, 1, 1, 1, 1, 1]
+    section_times[:] = [0, 0, 0, 0, 0, 0, 0]
+    dots[:] = []
+    # Shared variables are reused, so must be reset before each map
+
+    dot_resolution = map_resolution * scale ** 2
+    # Previews use fewer dots, but islands keep the size and number set by map_resolution
+    image_width = width // scale
+    image_height = height // scale
 
-            # Progress Tracking
+    # Progress Tracking
 
-            tracker_process = multiprocessing.Process(target=track_progress,
-                args=(section_progress, section_progress_total, section_times, start_time))
-            tracker_process.start()
+    tracker_process = multiprocessing.Process(target=track_progress,
+        args=(section_progress, section_progress_total, section_times, start_time))
+    if show_progress:
+        tracker_process.start()
 
-            section_times[0] = time.time() - start_time
-            # Everyting from "start_time = " to here is part of Setup
-            section_progress[0] = 1
+    try:
+
+        section_times[0] = time.time() - start_time
+        # Everyting from "start_time = " to here is part of Setup
+        section_progress[0] = 1
 
-            # Section Generation
-            # Creating the initial list of dots
+        # Section Generation
+        # Creating the initial list of dots
 
-            num_dots = width * height // map_resolution
-            # The map is divided by a number of dots, which form polygons out of the nearest pixels
-            # to each dot, so only dots are used during map generation, and pixels are only assigned
-            # at the very end
+        num_dots = width * height // dot_resolution
+        # The map is divided by a number of dots, which form polygons out of the nearest pixels
+        # to each dot, so only dots are used during map generation, and pixels are only assigned
+        # at the very end
 
-            section_progress_total[1] = num_dots
-            # A section's progress = section_progress[x] / section_progress_total[x]
-            # For this section, the total number of "steps" taken == num_dots
+        section_progress_total[1] = num_dots
+        # A section's progress = section_progress[x] / section_progress_total[x]
+        # For this section, the total number of "steps" taken == num_dots
 
-            coords = random.sample(range(0, width * height), num_dots)
-            # Randomly creates coords for each dot, not in any order
-            local_dots = [] # Faster to add items to local_dots than dots
+        coords = rng.sample(range(0, width * height), num_dots)
+        # Randomly creates coords for each dot, not in any order
+        local_dots = [] # Faster to add items to local_dots than dots
+        if prior_dots is None:
             num_special_dots = num_dots // island_abundance
+            num_origin_dots = min(
+                width * height // map_resolution // island_abundance, num_dots // 4
+            ) # Same as num_special_dots, unless this is a preview
+        else:
+            num_special_dots = 0 # Land is taken from prior_dots instead of "Land Origin" dots
+            num_origin_dots = 0
+
+        [local_dots.append(Dot(coords[i] % width, coords[i] // width, "Land Origin"))
+            for i in range(num_origin_dots)]
+        # Add x "Land Origin" dots with random coords to local_dots, where x = num_origin_dots
+        section_progress[1] = num_origin_dots
+        [local_dots.append(Dot(coords[i] % width, coords[i] // width, "Water Forced"))
+            for i in range(num_origin_dots, num_origin_dots + num_special_dots)]
+        section_progress[1] += num_special_dots
+        [local_dots.append(Dot(coords[i] % width, coords[i] // width, "Water"))
+            for i in range(num_origin_dots + num_special_dots, num_dots)]
+        section_progress[1] = num_dots
+
+        dots.extend(local_dots)
+
+        section_times[1] = time.time() - start_time - sum(section_times)
+
+        # Section Assignment
+        # Assigning dots as "Land", "Land Origin", "Water", or "Water Forced"
+
+        section_progress_total[2] = num_dots
+
+        piece_lengths = [num_dots // processes] * (processes - 1)
+        piece_lengths.append(num_dots - sum(piece_lengths))
+        piece_ranges = [
+            [i * piece_lengths[0], i * piece_lengths[0] + piece_lengths[i]]
+            for i in range(processes)
+        ]
+        # Used to create x pieces of around size num_dots / x, where x = num_processes
 
-            [local_dots.append(Dot(coords[i] % width, coords[i] // width, "Land Origin"))
-                for i in range(num_special_dots)]
-            # Add x "Land Origin" dots with random coords to local_dots, where x = num_special_dots
-            section_progress[1] = num_special_dots
-            [local_dots.append(Dot(coords[i] % width, coords[i] // width, "Water Forced"))
-                for i in range(num_special_dots, num_special_dots * 2)]
-            section_progress[1] += num_special_dots
-            [local_dots.append(Dot(coords[i] % width, coords[i] // width, "Water"))
-                for i in range(num_special_dots * 2, num_dots)]
-            section_progress[1] = num_dots
+        local_dots = []
+        results = pool.map(copy_piece, piece_ranges)
+        for result in results:
+            local_dots.extend(result)
+        # Copying dots in local_dots, since local variables are faster to access
 
-            dots.extend(local_dots)
+        origin_dots = [dot for dot in local_dots if dot.type == "Land Origin"]
 
-            section_times[1] = time.time() - start_time - sum(section_times)
+        if prior_dots is None:
+            run_pieces(pool, assign_sections, [
+                (map_resolution, island_size, seed, piece_ranges[i], origin_dots, local_dots)
+                for i in range(processes)
+            ], retries, piece_pids) # Waits for all processes to finish assign_sections
+        else:
+            run_pieces(pool, assign_sections_prior, [
+                (piece_ranges[i], prior_dots, local_dots) for i in range(processes)
+            ], retries, piece_pids)
 
-            # Section Assignment
-            # Assigning dots as "Land", "Land Origin", "Water", or "Water Forced"
+        section_times[2] = time.time() - start_time - sum(section_times)
 
-            section_progress_total[2] = num_dots
+        # Coastline Smoothing
 
-            piece_lengths = [num_dots // processes] * (processes - 1)
-            piece_lengths.append(num_dots - sum(piece_lengths))
-            piece_ranges = [
-                [i * piece_lengths[0], i * piece_lengths[0] + piece_lengths[i]]
-                for i in range(processes)
-            ]
-            # Used to create x pieces of around size num_dots / x, where x = num_processes
+        if coastline_smoothing != 0:
+
+            section_progress_total[3] = num_dots * 2
 
             local_dots = []
             results = pool.map(copy_piece, piece_ranges)
             for result in results:
                 local_dots.extend(result)
-            # Copying dots in local_dots, since local variables are faster to access
 
-            origin_dots = [dot for dot in local_dots if dot.type == "Land Origin"]
+            run_pieces(pool, smooth_coastlines, [
+                (coastline_smoothing, piece_ranges[i], local_dots) for i in range(processes)
+            ], retries, piece_pids) # piece_ranges is reused multiple times without being remade
 
-            results = []
-            # results list needed for result.wait(), no result is actually returned in most cases
-            for i in range(processes):
-                results.append(pool.apply_async(assign_sections,
-                    (map_resolution, island_size, piece_ranges[i], origin_dots, local_dots)))
-            [result.wait() for result in results] # Wait for all process to finish assign_sections
+        else: # Skip everything, no smoothing needed
 
-            section_times[2] = time.time() - start_time - sum(section_times)
+            section_progress[3] = 1
 
-            # Coastline Smoothing
+        section_times[3] = time.time() - start_time - sum(section_times)
 
-            if coastline_smoothing != 0:
+        # Biome Generation
+        # Creating biomes
 
-                section_progress_total[3] = num_dots * 2
+        section_progress_total[4] = num_dots
 
-                local_dots = []
-                results = pool.map(copy_piece, piece_ranges)
-                for result in results:
-                    local_dots.extend(result)
+        local_dots = []
+        results = pool.map(copy_piece, piece_ranges)
+        for result in results:
+            local_dots.extend(result)
 
-                results = []
-                for i in range(processes):
-                    results.append(pool.apply_async(smooth_coastlines,
-                        (coastline_smoothing, piece_ranges[i], local_dots)))
-                    # piece_ranges is reused multiple times without being remade
-                [result.wait() for result in results]
+        # Choosing "biome origin dots", which decide what biome that area of land will be
 
-            else: # Skip everything, no smoothing needed
+        if prior_dots is None:
 
-                section_progress[3] = 1
+            land_indexes = [
+                i for i in range(num_dots) if local_dots[i].type in ("Land", "Land Origin")
+            ]
+            num_biome_origin_dots = 0
+            if len(land_indexes) > 0:
+                num_biome_origin_dots = max(
+                    1, min(len(land_indexes) * scale ** 2 // 10, len(land_indexes))
+                ) # At least one origin, so all land has a biome to take
+            # Previews have 1 / scale ** 2 as many dots, so a larger share of them are used to
+            # keep biome sizes, scale ** 2 / 10 is more than 1 for PREVIEW_SCALE
+
+            biome_origin_dots = [
+                Dot(local_dots[i].x, local_dots[i].y, get_biome(local_dots[i].y, height, rng))
+                for i in rng.sample(land_indexes, num_biome_origin_dots)
+            ] # 10% of all land dots become biome origin dots, or every land dot in previews
 
-            section_times[3] = time.time() - start_time - sum(section_times)
+        else:
 
-            # Biome Generation
-            # Creating biomes
+            biome_origin_dots = [dot for dot in prior_dots if dot.type not in WATER_TYPES]
+            # Land dots of the coarser map become biome origin dots, keeping its biomes
 
-            section_progress_total[4] = num_dots
+        # Water depth, ice and land biomes are all decided in one pass, see generate_biomes
 
-            # Removing "Land Origin" and "Water Forced" dots, they aren't needed anymore
+        run_pieces(pool, generate_biomes, [
+            (piece_ranges[i], local_dots, biome_origin_dots, height) for i in range(processes)
+        ], retries, piece_pids)
 
-            local_dots = []
-            results = pool.map(copy_piece, piece_ranges)
-            for result in results:
-                local_dots.extend(result)
+        section_times[4] = time.time() - start_time - sum(section_times)
 
-            results = []
-            for i in range(processes):
-                results.append(pool.apply_async(clean_dots,
-                    (local_dots[piece_ranges[i][0]:piece_ranges[i][1]], piece_ranges[i][0])))
-            [result.wait() for result in results]
+        # Image Generation
 
-            # Creating water biomes to add depth and ice at poles
+        section_progress_total[5] = image_height
 
-            local_dots = []
-            results = pool.map(copy_piece, piece_ranges)
-            for result in results:
-                local_dots.extend(result)
+        local_dots = []
+        results = pool.map(copy_piece, piece_ranges)
+        for result in results:
+            local_dots.extend(result)
 
-            results = []
-            for i in range(processes):
-                results.append(pool.apply_async(
-                    generate_biomes_water, (piece_ranges[i], local_dots, height)))
-            [result.wait() for result in results]
+        check_dots(local_dots)
 
-            # Adding "biome origin dots", which decide what biome that area of land will be
+        start_heights = list(range(0, image_height, image_height // processes))
+        section_heights = [image_height // processes] * (processes - 1)
+        section_heights.append(image_height - sum(section_heights))
+        # Image is generated in x sections, where x = num_processes
+        # Sections are full width, but only around height / num_processes
 
-            local_dots = []
-            results = pool.map(copy_piece, piece_ranges)
+        if dots_only:
+
+            # Only the dots are needed, e.g. for a preview that a map is refined from
+
+            section_progress[5] = section_progress_total[5]
+
+            type_counts = None
+            image = None
+
+        elif sample_stride > 0:
+
+            # Statistics only, see sample_types
+
+            results = run_pieces(pool, sample_types, [
+                (start_heights[i], section_heights[i], sample_stride, local_dots, image_width,
+                scale)
+                for i in range(processes)
+            ], retries, piece_pids)
+
+            type_counts = [0] * 11 # Counting sampled pixels of each biome and water type
             for result in results:
-                local_dots.extend(result)
+                for i in range(11):
+                    type_counts[i] += result[i]
 
-            biome_origin_dot_indexes = [i for i in random.sample(range(0, num_dots), num_dots // 10)
-                if local_dots[i].type == "Land"] # 10% of all land dots become biome origin dots
+            # No image to check, run_pieces has already made sure every section was sampled
 
-            for i in biome_origin_dot_indexes:
+            section_times[5] = time.time() - start_time - sum(section_times)
 
-                dot = local_dots[i]
-                equator_dist = abs(dot.y - height / 2) / height * 20
-                # Distance from equator 0-10, where 0 is on equator and 10 is top or bottom of page
+            image = None
 
-                if equator_dist < 1:
-                    probs = ["Rock"] + ["Desert"] * 3 + ["Jungle"] * 3 + ["Forest"] * 2 + ["Plains"]
-                elif equator_dist < 2:
-                    probs = (
-                        ["Rock"] + ["Desert"] * 3 + ["Jungle"] * 2 + ["Forest"] * 2 + ["Plains"] * 2
-                    )
-                elif equator_dist < 3:
-                    probs = ["Rock"] + ["Desert"] * 2 + ["Jungle"] + ["Forest"] * 3 + ["Plains"] * 3
-                elif equator_dist < 4:
-                    probs = ["Rock"] + ["Desert"] + ["Jungle"] + ["Forest"] * 3 + ["Plains"] * 4
-                elif equator_dist < 5:
-                    probs = ["Rock"] + ["Desert"] + ["Forest"] * 4 + ["Plains"] * 4
-                elif equator_dist < 6:
-                    probs = ["Rock"] +  ["Forest"] * 5 + ["Plains"] * 4
-                elif equator_dist < 7:
-                    probs = ["Rock"] + ["Taiga"] + ["Forest"] * 5 + ["Plains"] * 3
-                elif equator_dist < 8:
-                    probs = (
-                        ["Rock"] +  ["Snow"] * 2 + ["Taiga"] * 2 + ["Forest"] * 3 + ["Plains"] * 2
+        else:
+
+            from multiprocessing import shared_memory
+            import PIL.Image
+            # Only imported here, so statistics only maps never wait for them
+            # "import multiprocessing.shared_memory" would make multiprocessing local to this
+            # function, including where it is used before this line
+
+            frame_buffer = shared_memory.SharedMemory(
+                create=True, size=image_width * image_height * 3 + image_height
+            ) # Every process writes its rows into this, so image sections never need to be copied
+            # Starts as all 0s, so no row is marked as written (see generate_image)
+
+            try:
+
+                results = run_pieces(pool, generate_image, [
+                    (start_heights[i], section_heights[i], 0, image_width, frame_buffer.name,
+                    start_heights[i], image_height, local_dots, range(num_dots), scale)
+                    for i in range(processes)
+                ], retries, piece_pids)
+
+                type_counts = [0] * 11 # Counting total pixels of each biome and water type
+                for result in results:
+                    for i in range(11):
+                        type_counts[i] += result[i]
+
+                check_pixels(frame_buffer, image_width, image_height)
+
+                section_times[5] = time.time() - start_time - sum(section_times)
+
+                # Image Saving
+
+                image = PIL.Image.frombuffer(
+                    "RGB", (image_width, image_height), frame_buffer.buf, "raw", "RGB", 0, 1
+                )
+                image.save(result_path, "PNG")
+
+            finally:
+                frame_buffer.close()
+                frame_buffer.unlink() # Frees the shared memory
+
+        section_times[6] = time.time() - start_time - sum(section_times)
+        section_progress[6] = 1
+
+    except:
+        if show_progress:
+            tracker_process.terminate() # Otherwise the progress screen would hide the error
+        raise
+
+    if show_progress:
+        tracker_process.join() # Tracker process closes self after all sections complete
+
+    state = MapState(
+        width, height, dot_resolution, coastline_smoothing, scale, seed, local_dots,
+        [dot.type not in WATER_TYPES for dot in local_dots], image
+    )
+
+    return state, type_counts
+
+def regenerate_region(
+    pool, processes, state, rectangle, seed, result_path, retries, dots, piece_pids
+):
+    # Redoes Coastline Smoothing and Biome Generation for the dots in rectangle, (x0, y0, x1, y1),
+    # then redoes Image Generation for only the pixels those dots cover
+    # state is updated in place, and its image is saved to result_path
+    # Types of dots in state can be changed between "Land" and "Water" before calling this,
+    # e.g. to draw a new island, or the same dots can be given a new seed to reroll biomes
+
+    import multiprocessing.shared_memory
+    import PIL.Image
+
+    rng = random.Random(seed) # See generate_map
+
+    x0, y0, x1, y1 = rectangle
+    x0, y0 = max(x0, 0), max(y0, 0)
+    x1, y1 = min(x1, state.width), min(y1, state.height)
+    # Parts of rectangle outside the map are ignored
+    if x0 >= x1 or y0 >= y1:
+        raise ValueError("rectangle " + str(tuple(rectangle)) + " has no area inside the map.")
+
+    halo = max(35, round(2 * math.sqrt(state.map_resolution * max(state.coastline_smoothing, 1))))
+    # Water depth looks for land up to 35 pixels away, and coastline smoothing looks at the
+    # nearest coastline_smoothing dots, so dots within halo of the rectangle are redone as well,
+    # and dots within halo of those are used (but not changed) so the region joins the map
+
+    region_indexes = [] # Dots that are redone
+    context_indexes = [] # Dots that are only used to redo region dots
+    for i in range(len(state.dots)):
+        dot = state.dots[i]
+        if x0 - halo <= dot.x < x1 + halo and y0 - halo <= dot.y < y1 + halo:
+            region_indexes.append(i)
+        elif x0 - halo * 2 <= dot.x < x1 + halo * 2 and y0 - halo * 2 <= dot.y < y1 + halo * 2:
+            context_indexes.append(i)
+    dot_indexes = region_indexes + context_indexes
+    num_region_dots = len(region_indexes)
+
+    changed_indexes = [i for i in context_indexes if state.dots[i].type not in DOT_TYPES]
+    if len(changed_indexes) > 0:
+        raise ValueError(
+            str(len(changed_indexes)) + " dot(s) just outside rectangle " + str(tuple(rectangle)) +
+            " were changed to \"Land\", make the rectangle larger to include them."
+        ) # Context dots keep their types, so they need a biome, see biome_origin_dots below
+
+    local_dots = []
+    for i in dot_indexes:
+        dot = state.dots[i]
+        if dot.type in WATER_TYPES:
+            local_dots.append(Dot(dot.x, dot.y, "Water"))
+        else:
+            local_dots.append(Dot(dot.x, dot.y, "Land"))
+    # Biomes are removed, so dots are back to how they were before Coastline Smoothing
+
+    dots[:] = local_dots
+    # Region dots come first, so piece_ranges only include region dots
+
+    piece_lengths = [num_region_dots // processes] * (processes - 1)
+    piece_lengths.append(num_region_dots - sum(piece_lengths))
+    piece_ranges = [
+        [i * piece_lengths[0], i * piece_lengths[0] + piece_lengths[i]]
+        for i in range(processes)
+    ]
+
+    has_land = "Land" in [dot.type for dot in local_dots]
+    has_water = "Water" in [dot.type for dot in local_dots]
+    edited = len([
+        i for i in range(len(dot_indexes)) if (local_dots[i].type == "Land") !=
+        state.land[dot_indexes[i]]
+    ]) > 0
+    # Dots were changed between land and water, e.g. to draw a new island
+    # Otherwise the coastline is already smoothed, and smoothing it again would move it
+
+    # Coastline Smoothing
+
+    if state.coastline_smoothing != 0 and has_land and has_water and edited:
+    # Nothing to smooth if there is no coastline, or no new coastline
+
+        run_pieces(pool, smooth_coastlines, [
+            (state.coastline_smoothing, piece_ranges[i], local_dots) for i in range(processes)
+        ], retries, piece_pids)
+
+        results = pool.map(copy_piece, piece_ranges)
+        context_dots = local_dots[num_region_dots:]
+        local_dots = []
+        for result in results:
+            local_dots.extend(result)
+        local_dots.extend(context_dots)
+
+    # Biome Generation
+
+    region_land_indexes = [i for i in range(num_region_dots) if local_dots[i].type == "Land"]
+    num_biome_origin_dots = 0
+    if len(region_land_indexes) > 0:
+        num_biome_origin_dots = max(1, len(region_land_indexes) // 10)
+    # At least one origin, so land in a small region always has a biome to take
+
+    biome_origin_dots = [
+        Dot(local_dots[i].x, local_dots[i].y, get_biome(local_dots[i].y, state.height, rng))
+        for i in rng.sample(region_land_indexes, num_biome_origin_dots)
+    ] # 10% of land dots in the region become biome origin dots
+    biome_origin_dots.extend([state.dots[i] for i in context_indexes
+        if state.dots[i].type in DOT_TYPES[4:]]) # Only land biomes
+    # Land just outside the region keeps its biome, and can spread it into the region
+
+    run_pieces(pool, generate_biomes, [
+        (piece_ranges[i], local_dots, biome_origin_dots, state.height) for i in range(processes)
+    ], retries, piece_pids)
+    # All water with no land nearby becomes "Deep Water" in generate_biomes
+
+    results = pool.map(copy_piece, piece_ranges)
+    local_dots = []
+    for result in results:
+        local_dots.extend(result)
+    local_dots.extend([state.dots[i] for i in context_indexes])
+    # Context dots are used with their biomes again, as they aren't changed
+
+    check_dots(local_dots)
+
+    # Image Generation
+
+    image_width, image_height = state.image.size
+
+    start_width = max(0, (x0 - halo - halo // 2) // state.scale)
+    start_height = max(0, (y0 - halo - halo // 2) // state.scale)
+    section_width = min(image_width, -(-(x1 + halo + halo // 2) // state.scale)) - start_width
+    region_height = min(image_height, -(-(y1 + halo + halo // 2) // state.scale)) - start_height
+    # Pixels up to halo / 2 outside the region can be closest to a region dot
+    # Context dots are closer than region dots for pixels further out than that
+
+    sections = min(processes, region_height)
+    start_heights = [start_height + i * (region_height // sections) for i in range(sections)]
+    section_heights = [region_height // sections] * (sections - 1)
+    section_heights.append(region_height - sum(section_heights))
+
+    frame_buffer = multiprocessing.shared_memory.SharedMemory(
+        create=True, size=section_width * region_height * 3 + region_height
+    ) # Only as large as the pixels being generated again, see generate_map
+
+    try:
+
+        run_pieces(pool, generate_image, [
+            (start_heights[i], section_heights[i], start_width, section_width, frame_buffer.name,
+            start_heights[i] - start_height, region_height, local_dots, dot_indexes, state.scale)
+            for i in range(sections)
+        ], retries, piece_pids)
+
+        check_pixels(frame_buffer, section_width, region_height)
+
+        for i in range(num_region_dots):
+            state.dots[region_indexes[i]] = local_dots[i]
+            state.land[region_indexes[i]] = local_dots[i].type not in WATER_TYPES
+        # state is only changed once the region has been checked
+
+        state.image.paste(PIL.Image.frombuffer(
+            "RGB", (section_width, region_height), frame_buffer.buf, "raw", "RGB", 0, 1
+        ), (start_width, start_height)) # Replaces the old pixels
+        state.image.save(result_path, "PNG")
+
+    finally:
+        frame_buffer.close()
+        frame_buffer.unlink()
+
+    return state
+
+async def serve_maps(
+    pool, processes, port, retries,
+    section_progress, section_progress_total, section_times, dots, piece_pids
+):
+    # Local HTTP server for generating maps without starting BiomeGen for each one
+    # POST /maps with a JSON object of settings (see parse_settings) streams back the png
+    # GET /progress returns the progress of the map being generated, from section_progress
+
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(SERVER_QUEUE_SIZE)
+    jobs = {} # Settings of each queued map and its future, so identical requests share a map
+    running = [None] # Settings of the map being generated
+
+    async def generate_queued_maps():
+
+        while True:
+
+            settings, future = await queue.get()
+            running[0] = settings
+
+            try:
+
+                image_file = io.BytesIO()
+                width, height, map_resolution, island_abundance, island_size, \
+                    coastline_smoothing, seed, preview = settings
+
+                def generate_levels():
+
+                    prior_dots = None
+                    if preview:
+                        state, type_counts = generate_map(
+                            pool=pool, processes=processes, width=width, height=height,
+                            map_resolution=map_resolution, island_abundance=island_abundance,
+                            island_size=island_size, coastline_smoothing=coastline_smoothing,
+                            seed=seed, scale=PREVIEW_SCALE, prior_dots=None, result_path=None,
+                            retries=retries, show_progress=False, sample_stride=0,
+                            dots_only=True, section_progress=section_progress,
+                            section_progress_total=section_progress_total,
+                            section_times=section_times, dots=dots, piece_pids=piece_pids
+                        ) # Only the preview's dots are used
+                        prior_dots = state.dots
+
+                    generate_map(
+                        pool=pool, processes=processes, width=width, height=height,
+                        map_resolution=map_resolution, island_abundance=island_abundance,
+                        island_size=island_size, coastline_smoothing=coastline_smoothing,
+                        seed=seed, scale=1, prior_dots=prior_dots, result_path=image_file,
+                        retries=retries, show_progress=False, sample_stride=0, dots_only=False,
+                        section_progress=section_progress,
+                        section_progress_total=section_progress_total,
+                        section_times=section_times, dots=dots, piece_pids=piece_pids
                     )
-                elif equator_dist < 9:
-                    probs = ["Snow"] * 4 + ["Taiga"] * 5 + ["Forest"]
+
+                await loop.run_in_executor(None, generate_levels)
+                # Generated in another thread so requests are still answered meanwhile
+
+                future.set_result(image_file.getvalue())
+
+            except Exception as error:
+                raise_error("serve_maps", traceback.format_exc())
+                future.set_exception(error)
+
+            running[0] = None
+            del jobs[settings]
+
+    async def send(writer, status, content_type, body):
+        writer.write((
+            "HTTP/1.1 " + status + "\r\nContent-Type: " + content_type +
+            "\r\nContent-Length: " + str(len(body)) + "\r\nConnection: close\r\n\r\n"
+        ).encode() + body)
+        await writer.drain()
+
+    async def handle_connection(reader, writer):
+
+        try:
+
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            valid_headers = True
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                # latin-1 decodes any bytes, so invalid text is refused below instead of raising
+                if line == "":
+                    break
+                if ":" not in line:
+                    valid_headers = False # Still read, so the rest of the request is skipped
+                    continue
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+            if len(request_line) < 2 or not valid_headers:
+                await send(writer, "400 Bad Request", "text/plain", b"Invalid request.")
+
+            elif request_line[0] == "GET" and request_line[1] == "/progress":
+
+                progress = {
+                    "running": running[0] is not None,
+                    "queued": queue.qsize(),
+                    "sections": {},
+                    "total": 0
+                }
+                if running[0] is not None:
+                    for i in range(len(SECTION_NAMES)):
+                        progress_section = min(section_progress[i] / section_progress_total[i], 1)
+                        progress["sections"][SECTION_NAMES[i]] = progress_section
+                        progress["total"] += progress_section * SECTION_WEIGHTS[i]
+                    # Same as track_progress
+
+                await send(
+                    writer, "200 OK", "application/json", json.dumps(progress).encode()
+                )
+
+            elif request_line[0] == "POST" and request_line[1] == "/maps":
+
+                try:
+                    content_length = int(headers.get("content-length", 0))
+                    if content_length < 0:
+                        raise ValueError
+                except ValueError:
+                    await send(writer, "400 Bad Request", "text/plain", b"Invalid Content-Length.")
+                    return
+
+                body = await reader.readexactly(content_length)
+
+                try:
+                    settings = parse_settings(json.loads(body))
+                except ValueError as error: # Includes invalid JSON
+                    await send(writer, "400 Bad Request", "text/plain", str(error).encode())
+                    return
+
+                if settings in jobs:
+                    future = jobs[settings] # Same map was already requested
+                elif queue.full():
+                    await send(writer, "503 Service Unavailable", "text/plain",
+                        b"Too many maps queued, try again later.")
+                    return
                 else:
-                    probs = ["Snow"] * 10
-
-                # Probability Chart, 1 box = 10% Chance
-                # r = Rock, D = Desert, etc. Numbers represent equator distance
-                # Uppercase/lowercase are an attempt to make it easier to read, they mean nothing
-                # 0-1 | r D D D J J J f f P
-                # 1-2 | r D D D J J f f P P
-                # 2-3 | r D D J f f f P P P
-                # 3-4 | r D J f f f P P P P
-                # 4-5 | r D f f f f P P P P
-                # 5-6 | r f f f f f P P P P
-                # 6-7 | r T f f f f f P P P
-                # 7-8 | r s s T T f f f P P
-                # 8-9 | s s s s T T T T f f
-                # 9-10| s s s s s s s s s s
-
-                dot_type = probs[random.randint(0, 9)]
-
-                dots[i] = Dot(dot.x, dot.y, dot_type)
+                    future = loop.create_future()
+                    jobs[settings] = future
+                    queue.put_nowait((settings, future))
+
+                try:
+                    png = await asyncio.shield(future)
+                    # Shielded so one request closing doesn't cancel the map for the others
+                except Exception:
+                    await send(writer, "500 Internal Server Error", "text/plain",
+                        b"Generation failed, see errors.txt for details.")
+                    return
+
+                writer.write((
+                    "HTTP/1.1 200 OK\r\nContent-Type: image/png\r\nX-Seed: " + str(settings[6]) +
+                    "\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+                ).encode())
+                for i in range(0, len(png), SERVER_CHUNK_SIZE):
+                    chunk = png[i:i + SERVER_CHUNK_SIZE]
+                    writer.write(format(len(chunk), "x").encode() + b"\r\n" + chunk + b"\r\n")
+                    await writer.drain() # Waits for slow clients instead of buffering the png
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
 
-                section_progress[4] += 1
+            else:
+                await send(writer, "404 Not Found", "text/plain", b"Not found.")
 
-            # Add land biomes, dots are assigned the biome of the nearest biome origin dot
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass # Client closed the connection
 
-            local_dots = []
-            results = pool.map(copy_piece, piece_ranges)
-            for result in results:
-                local_dots.extend(result)
+        except:
+            raise_error("handle_connection", traceback.format_exc())
 
-            biome_origin_dots = [local_dots[i] for i in biome_origin_dot_indexes]
+        finally:
+            writer.close()
 
-            results = []
-            for i in range(processes):
-                results.append(pool.apply_async(
-                    assign_biomes, (piece_ranges[i], biome_origin_dots, local_dots)))
-            [result.wait() for result in results]
+    generator_task = asyncio.create_task(generate_queued_maps())
+    server = await asyncio.start_server(handle_connection, "127.0.0.1", port)
+    # Only reachable from this computer
 
-            section_times[4] = time.time() - start_time - sum(section_times)
+    print("BiomeGen server running at http://127.0.0.1:" + str(port) + "/")
 
-            # Image Generation
+    async with server:
+        await server.serve_forever()
 
-            section_progress_total[5] = height
+    generator_task.cancel()
 
-            local_dots = []
-            results = pool.map(copy_piece, piece_ranges)
-            for result in results:
-                local_dots.extend(result)
+def run_server(processes, port, retries):
 
-            start_heights = list(range(0, height, height // processes))
-            section_heights = [height // processes] * (processes - 1)
-            section_heights.append(height - sum(section_heights))
-            # Image is generated in x sections, where x = num_processes
-            # Sections are full width, but only around height / num_processes
+    import asyncio
 
-            results = []
-            for i in range(processes):
-                results.append(pool.apply_async(generate_image,
-                    (start_heights[i], section_heights[i], i, local_dots, width)))
-                # i tells process which section it is
-            [result.wait() for result in results]
+    with start_pool(processes) as (
+        pool, section_progress, section_progress_total, section_times, dots, piece_pids
+    ): # One pool is shared by every request
 
-            type_counts = [0] * 11 # Counting total pixels of each biome and water type
-            for result in results:
-                for i in range(11):
-                    type_counts[i] += result.get()[i]
+        try:
+            asyncio.run(serve_maps(
+                pool, processes, port, retries,
+                section_progress, section_progress_total, section_times, dots, piece_pids
+            ))
+        except KeyboardInterrupt:
+            pass # Ctrl + C stops the server
 
-            section_times[5] = time.time() - start_time - sum(section_times)
+def run_region(state_path, rectangle, seed, result_path, processes, retries):
+
+    # Regenerates rectangle of the map saved at state_path (see regenerate_region), saving the
+    # image to result_path and the changed map back to state_path
+    # Dot types can be changed in the saved map first, e.g. to draw a new island
 
-            # Image Stitching
+    start_time = time.time()
 
-            image = PIL.Image.new("RGB", (width, height), (255, 51, 133)) # Create blank image
-            shift = 0
-            for section in image_sections: # Adds image section onto image
-                image.paste(section, (0, shift))
-                shift += section_heights[0]
-            image.save("result.png") # Change this to change result location
+    state = load_state(state_path)
 
-            section_times[6] = time.time() - start_time - sum(section_times)
-            section_progress[6] = 1
+    with start_pool(processes) as (
+        pool, section_progress, section_progress_total, section_times, dots, piece_pids
+    ):
 
+        try:
+            regenerate_region(
+                pool, processes, state, rectangle, seed, result_path, retries, dots, piece_pids
+            )
+        except ValueError as error: # Rectangle is outside the map, or too small for the changes
+            print(error)
+            return
         except:
-            raise_error("main", traceback.format_exc())
+            raise_error("run_region", traceback.format_exc())
+            print("Generation failed, see errors.txt for details.")
+            return
+
+    save_state(state, state_path)
 
-    tracker_process.join() # Tracker process closes self after all sections complete
     print(
-        ANSI_GREEN + "Generation Complete " + ANSI_RESET +
-        format_time(time.time() - start_time) + "\n\nStatistics"
+        "Region regenerated in " + format_time(time.time() - start_time).strip() +
+        "\n\nSeed " + str(seed)
     )
 
-    types = (
-        "Ice", "Shallow Water", "Water", "Deep Water",
-        "Rock", "Desert", "Jungle", "Forest", "Plains", "Taiga", "Snow"
+def run_stats(settings, processes, sample_stride, retries):
+
+    # Prints the statistics main prints, for a map with settings (see parse_settings)
+    # No image is generated, types are counted from one pixel in every sample_stride squared
+
+    width, height, map_resolution, island_abundance, island_size, coastline_smoothing, seed, \
+        preview = settings
+
+    with start_pool(processes) as (
+        pool, section_progress, section_progress_total, section_times, dots, piece_pids
+    ):
+
+        try:
+
+            prior_dots = None
+            if preview:
+                state, type_counts = generate_map(
+                    pool=pool, processes=processes, width=width, height=height,
+                    map_resolution=map_resolution, island_abundance=island_abundance,
+                    island_size=island_size, coastline_smoothing=coastline_smoothing, seed=seed,
+                    scale=PREVIEW_SCALE, prior_dots=None, result_path=None, retries=retries,
+                    show_progress=False, sample_stride=0, dots_only=True,
+                    section_progress=section_progress,
+                    section_progress_total=section_progress_total, section_times=section_times,
+                    dots=dots, piece_pids=piece_pids
+                ) # Same as serve_maps
+                prior_dots = state.dots
+
+            state, type_counts = generate_map(
+                pool=pool, processes=processes, width=width, height=height,
+                map_resolution=map_resolution, island_abundance=island_abundance,
+                island_size=island_size, coastline_smoothing=coastline_smoothing, seed=seed,
+                scale=1, prior_dots=prior_dots, result_path=None, retries=retries,
+                show_progress=False, sample_stride=sample_stride, dots_only=False,
+                section_progress=section_progress, section_progress_total=section_progress_total,
+                section_times=section_times, dots=dots, piece_pids=piece_pids
+            )
+
+        except:
+            raise_error("run_stats", traceback.format_exc())
+            print("Generation failed, see errors.txt for details.")
+            return
+
+    print("Seed " + str(seed) + "\n\nStatistics (" + str(sum(type_counts)) + " pixels sampled)")
+    if sample_stride > 1:
+        print_statistics(type_counts, sum(type_counts))
+    else:
+        print_statistics(type_counts, 0) # Every pixel was sampled, so there is no error
+
+def main(retries, state_path, seed):
+
+    clear_screen()
+
+    # Copyright, license notice, etc.
+    print(
+        "Welcome to BiomeGen v1.0\n" +
+        "Copyright (C) 2025 Liam Ralph\n" +
+        "https://github.com/liam-ralph\n" +
+        "This project is licensed under the GNU General Public License v3.0,\n" +
+        "except for result.png, this program's output, licensed under The Unlicense.\n" +
+        "\u001b[38;5;1mWARNING: In some terminals, the refreshing progress screen\n" + 
+        "may flash, which could cause problems for people with epilepsy.\n" + ANSI_RESET +
+        "Press ENTER to begin."
     )
-    text_colors = ("117", "21", "19", "17", "243", "229", "22", "28", "40", "48", "255")
-    # Colored text for biome labels
+    # I do not know if the flashing lights this program sometimes makes could reasonably cause
+    # epilepsy or not, but I put this just in case
+    input()
+    clear_screen()
+
+    print("Map Width (pixels):")
+    width = get_int(*SETTING_RANGES["width"])
+
+    print("\nMap Height:")
+    height = get_int(*SETTING_RANGES["height"])
 
-    count_water = sum(type_counts[:4])
-    count_land = sum(type_counts[4:])
     print(
-        "Water " +
-        "{:.2f}%".format(count_water / (height * width) * 100).rjust(6)
+        "\nMap resolution controls the section size of the map.\n" +
+        "Choose a number between 50 and 500. 100 is the default.\n" +
+        "Larger numbers produce lower resolutions, with larger pieces\n" +
+        "while lower numbers take longer to generate.\n" +
+        "Map Resolution:"
     )
+    map_resolution = get_int(*SETTING_RANGES["map_resolution"])
+
     print(
-        "Land  " +
-        "{:.2f}%".format(count_land / (height * width) * 100).rjust(6)
+        "\nIsland abundance control how many islands there are,\n" +
+        "and the ration of land to water.\n" +
+        "Choose a number between 10 and 1000. 120 is the default.\n" +
+        "Larger numbers produces less land.\n" +
+        "Island Abundance:"
     )
+    island_abundance = get_int(*SETTING_RANGES["island_abundance"])
 
-    print("     % of Land/Water | % of Total")
-    for i in range(11):
-        if i < 4:
-            count_group = count_water
-        else:
-            count_group = count_land
-        print(
-            "\u001b[48;5;" + text_colors[i] + "m" + types[i].ljust(13) + ANSI_RESET + # Label
-            "{:.2f}%".format(type_counts[i] / count_group * 100).rjust(7) + " | " +
-            # Percentage of land/water e.g. 30% of all land is forest
-            "{:.2f}%".format(type_counts[i] / (height * width) * 100).rjust(6) # Overall percentage
-        )
+    print(
+        "\nIsland size controls average island size.\n" +
+        "Choose a number between 10 and 100. 50 is the default.\n" +
+        "Larger numbers produce larger islands.\n" +
+        "Island Size:"
+    )
+    island_size = get_int(*SETTING_RANGES["island_size"]) / 10
+
+    print(
+        "\nCoastline smoothing controls how smooth or rough coastlines look.\n" +
+        "Choose a number between 1 and 100. Larger numbers cause more smoothing.\n" +
+        "A value of 0 causes no smoothing. A value of 5 causes some smoothing,\n" +
+        "and is the default value.\n" +
+        "Coastline Smoothing:"
+    )
+    coastline_smoothing = get_int(*SETTING_RANGES["coastline_smoothing"])
+
+    print(
+        "\nNow you must choose how many of your CPU's threads to use for map generation.\n" +
+        "Values exceeding your CPU's number of threads will slow map generation.\n" +
+        "The most efficient number of threads to use varies by hardware, OS,\n" +
+        "and CPU load. Values less than 4 threads are usually very inefficient.\n" +
+        "Ensure you monitor your CPU for overheating, and halt the program if\n" +
+        "high temperatures occur. Using fewer threads may reduce temperatures.\n" +
+        "Number of Threads:"
+    )
+    processes = get_int(*SETTING_RANGES["processes"])
+
+    print(
+        "\nPreview mode first creates a smaller, rougher map and saves it to preview.png,\n" +
+        "then refines it into the full map, keeping the same land and biomes.\n" +
+        "Choose 1 to use preview mode, or 0 to create the full map only.\n" +
+        "Preview Mode:"
+    )
+    preview = get_int(0, 1)
+
+    if seed is None:
+        seed = random.SystemRandom().randrange(2 ** 32) # Printed at the end, see MapState
+
+    start_time = time.time()
+
+    clear_screen()
+
+    levels = [(1, "result.png")] # Change this to change result location
+    if preview == 1:
+        levels.insert(0, (PREVIEW_SCALE, "preview.png"))
+    # Each level is a (scale, result path) pair, and uses the dots of the level before it
+
+    with start_pool(processes) as (
+        pool, section_progress, section_progress_total, section_times, dots, piece_pids
+    ):
+
+        try:
+
+            prior_dots = None
+
+            for scale, result_path in levels:
+                state, type_counts = generate_map(
+                    pool=pool, processes=processes, width=width, height=height,
+                    map_resolution=map_resolution, island_abundance=island_abundance,
+                    island_size=island_size, coastline_smoothing=coastline_smoothing, seed=seed,
+                    scale=scale, prior_dots=prior_dots, result_path=result_path,
+                    retries=retries, show_progress=True, sample_stride=0, dots_only=False,
+                    section_progress=section_progress,
+                    section_progress_total=section_progress_total, section_times=section_times,
+                    dots=dots, piece_pids=piece_pids
+                )
+                prior_dots = state.dots
+
+        except:
+            raise_error("main", traceback.format_exc())
+            print("\u001b[38;5;1mGeneration Failed" + ANSI_RESET + "\nSee errors.txt for details.")
+            return
+
+    if state_path is not None:
+        save_state(state, state_path) # For --regenerate
+
+    print(
+        ANSI_GREEN + "Generation Complete " + ANSI_RESET +
+        format_time(time.time() - start_time) + "\n\nSeed " + str(seed) + "\n\nStatistics"
+    )
 
+    print_statistics(type_counts, 0)
 
 if __name__ == "__main__":
-    main()
+
+    parser = argparse.ArgumentParser(
+        description="BiomeGen, a terminal application for generating png maps."
+    )
+    parser.add_argument("--serve", action="store_true",
+        help="run a local HTTP server for generating maps instead of asking for settings")
+    parser.add_argument("--port", type=int, default=8000, help="port for --serve (default 8000)")
+    parser.add_argument("--threads", type=int,
+        default=min(os.cpu_count() or 1, SETTING_RANGES["processes"][1]),
+        help="number of CPU threads used by --serve, --dry-run, --stats and --regenerate " +
+        "(default all, up to " + str(SETTING_RANGES["processes"][1]) + ")")
+    parser.add_argument("--dry-run", action="store_true",
+        help="check the settings below and estimate dots, memory and time, without generating")
+    parser.add_argument("--stats", action="store_true",
+        help="generate a map with the settings below and print its statistics, without an image")
+    parser.add_argument("--stats-stride", type=int, default=10,
+        help="--stats samples one pixel in every stride x stride square (default 10)")
+    parser.add_argument("--start-method", choices=multiprocessing.get_all_start_methods(),
+        help="how pool processes are started (default depends on OS and Python version), " +
+        "forkserver imports scipy once for every pool process")
+    parser.add_argument("--retries", type=int, default=RETRIES,
+        help="times a failed piece is run again before generation stops, 0 stops at the first " +
+        "failure (default 2)")
+    parser.add_argument("--state",
+        help="file the finished map is saved to, so it can be changed with --regenerate")
+    parser.add_argument("--regenerate", type=int, nargs=4, metavar=("X0", "Y0", "X1", "Y1"),
+        help="regenerate the rectangle from (X0, Y0) to (X1, Y1) of the map saved in --state, " +
+        "saving it to result.png")
+    parser.add_argument("--preview", action="store_true",
+        help="make the --stats map in preview mode, refined from a smaller, rougher map")
+    parser.add_argument("--seed", type=int,
+        help="seed of the map, or of new biomes with --regenerate (default random)")
+    parser.add_argument("--width", type=int)
+    parser.add_argument("--height", type=int)
+    parser.add_argument("--map-resolution", type=int, default=100)
+    parser.add_argument("--island-abundance", type=int, default=120)
+    parser.add_argument("--island-size", type=int, default=50)
+    parser.add_argument("--coastline-smoothing", type=int, default=5)
+    arguments = parser.parse_args()
+
+    if arguments.retries < 0:
+        parser.error("retries must be at least 0.")
+    min_threads, max_threads = SETTING_RANGES["processes"]
+    if not min_threads <= arguments.threads <= max_threads:
+        parser.error("threads must be between " + str(min_threads) + " and " +
+            str(max_threads) + " (both inclusive).")
+    # Checked for every mode, piece_pids (see start_pool) only has room for max_threads pieces
+    if arguments.seed is not None and arguments.seed < 0:
+        parser.error("seed must be a positive whole number.") # Same as parse_settings
+
+    if arguments.start_method is not None:
+        multiprocessing.set_start_method(arguments.start_method)
+    if multiprocessing.get_start_method() == "forkserver": # Default on Linux from Python 3.14
+        multiprocessing.set_forkserver_preload(["scipy.spatial"])
+        # Pool processes are started by a fork server, which imports scipy once for all of them
+
+    if arguments.regenerate is not None:
+
+        if arguments.state is None:
+            parser.error("--regenerate needs the --state of the map to change.")
+        if arguments.seed is None:
+            arguments.seed = random.SystemRandom().randrange(2 ** 32) # See parse_settings
+
+    elif arguments.dry_run or arguments.stats:
+
+        request = {
+            "width": arguments.width,
+            "height": arguments.height,
+            "map_resolution": arguments.map_resolution,
+            "island_abundance": arguments.island_abundance,
+            "island_size": arguments.island_size,
+            "coastline_smoothing": arguments.coastline_smoothing
+        }
+        if arguments.seed is not None:
+            request["seed"] = arguments.seed
+        request["preview"] = arguments.preview
+
+        try:
+            settings = parse_settings(request)
+        except ValueError as error:
+            parser.error(str(error))
+        if not 1 <= arguments.stats_stride <= min(settings[0], settings[1]):
+            parser.error("stats-stride must be between 1 and the smaller of width and height.")
+            # A larger stride would sample no pixels
+
+    if arguments.regenerate is not None:
+        run_region(
+            arguments.state, arguments.regenerate, arguments.seed, "result.png", arguments.threads,
+            arguments.retries
+        )
+    elif arguments.dry_run:
+
+        num_dots, memory, seconds = estimate_map(
+            settings[0], settings[1], settings[2], settings[5], arguments.threads
+        )
+        print("Settings are valid.")
+        print("Dots           " + str(num_dots))
+        print("Memory (est.)  " + "{:.2f} GB".format(memory / 1_000_000_000))
+        print("Time (est.)    " + format_time(seconds).strip())
+
+    elif arguments.stats:
+        run_stats(settings, arguments.threads, arguments.stats_stride, arguments.retries)
+    elif arguments.serve:
+        run_server(arguments.threads, arguments.port, arguments.retries)
+    else:
+        main(arguments.retries, arguments.state, arguments.seed)